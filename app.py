@@ -1,20 +1,45 @@
 import telebot
 from telebot import types
-import psycopg2
-from psycopg2 import Error
-from datetime import datetime, timedelta
+from psycopg2 import DataError, Error, IntegrityError, ProgrammingError
+from datetime import date, datetime, timedelta
+import atexit
+import json
 import os
+import queue
+import signal
+import threading
+import time
 from functools import wraps
 
+from repository import InMemoryRepository, PostgresRepository, query_counter
+
 
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 DB_URI = os.environ.get("DB_URI")
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")  
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")  
+MEMBER_SEARCH_LIMIT = int(os.environ.get("MEMBER_SEARCH_LIMIT", 8))
+MEMBER_SEARCH_MIN_LENGTH = 3
+RECONCILE_INTERVAL_HOURS = float(os.environ.get("RECONCILE_INTERVAL_HOURS", 24))
+RECONCILE_BATCH_SIZE = 500
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_SECONDS = 2
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_MAX_RETRIES = 3
+AUDIT_MAX_BACKOFF_SECONDS = 60
+# خطاهایی که به خود ردیف‌ها مربوط‌اند؛ فقط این‌ها باعث نصف شدن دسته و کنار گذاشتن ردیف می‌شوند
+AUDIT_DATA_ERRORS = (DataError, IntegrityError, ProgrammingError)
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", 4))
 
 bot = telebot.TeleBot(BOT_TOKEN)
 
+# DATA_BACKEND=memory ربات را بدون پایگاه داده و با داده‌های درون حافظه اجرا می‌کند
+if os.environ.get("DATA_BACKEND") == "memory":
+    repo = InMemoryRepository()
+else:
+    repo = PostgresRepository(DB_URI)
+
 # دیکشنری برای ذخیره وضعیت لاگین کاربران
 user_sessions = {}
 
@@ -33,66 +58,202 @@ def login_required(func):
         return func(message, *args, **kwargs)
     return wrapper
 
-def get_db_connection():
+def query_budget(func):
+    """دکوراتور برای شمارش کوئری‌های هر به‌روزرسانی و هشدار در صورت عبور از QUERY_BUDGET"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        query_counter.begin()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            count = query_counter.end()
+            if count is not None and count > QUERY_BUDGET:
+                print(f"هشدار: {func.__name__} {count} کوئری اجرا کرد (بودجه: {QUERY_BUDGET})")
+    return wrapper
+
+# صف رویدادهای ممیزی که در پس‌زمینه و به صورت دسته‌ای در پایگاه داده نوشته می‌شوند
+audit_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+audit_stop = threading.Event()
+audit_writer = None
+
+def audit(chat_id, action, entity_type, entity_id, **payload):
+    """ثبت یک تغییر در صف ممیزی بدون رفت و برگشت به پایگاه داده"""
+    event = (chat_id, action, entity_type, entity_id,
+             json.dumps(payload, ensure_ascii=False, default=str), datetime.now())
     try:
-        connection = psycopg2.connect(DB_URI)
-        return connection
-    except Error as e:
-        print(f"خطا در اتصال به پایگاه داده: {e}")
-        return None
+        audit_queue.put_nowait(event)
+    except queue.Full:
+        print(f"صف ممیزی پر است؛ رویداد {action} {entity_type} {entity_id} ثبت نشد.")
+
+def audit_loan(chat_id, action, borrowing_id, book_id, member_id, **payload):
+    """ثبت رویداد امانت برای امانت، کتاب و عضو تا تاریخچه هر سه قابل جستجو باشد"""
+    payload.update(borrowing_id=borrowing_id, book_id=book_id, member_id=member_id)
+    audit(chat_id, action, 'borrowing', borrowing_id, **payload)
+    audit(chat_id, action, 'book', book_id, **payload)
+    audit(chat_id, action, 'member', member_id, **payload)
+
+def write_audit_batch(batch):
+    """نوشتن یک دسته رویداد ممیزی با یک INSERT چندردیفی؛ خطای پایگاه داده به فراخواننده می‌رسد"""
+    repo.insert_audit_batch(batch, page_size=AUDIT_BATCH_SIZE)
+
+def write_audit_rows(batch):
+    """نوشتن دسته با نصف کردن پیاپی تا ردیف‌های خراب جدا و کنار گذاشته شوند
+
+    خروجی: ردیف‌هایی که به خاطر خطای اتصال نوشته نشدند و باید دوباره تلاش شوند
+    """
+    try:
+        write_audit_batch(batch)
+        return []
+    except AUDIT_DATA_ERRORS as e:
+        if len(batch) == 1:
+            print(f"رویداد ممیزی کنار گذاشته شد: {batch[0][:4]}: {e}")
+            return []
+    except Error:
+        return batch
+    middle = len(batch) // 2
+    return write_audit_rows(batch[:middle]) + write_audit_rows(batch[middle:])
+
+def drain_audit_queue(batch, timeout):
+    """جمع کردن رویدادها تا پر شدن دسته یا گذشتن زمان"""
+    deadline = time.monotonic() + timeout
+    while len(batch) < AUDIT_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try:
+            event = audit_queue.get(timeout=remaining) if remaining > 0 else audit_queue.get_nowait()
+        except queue.Empty:
+            break
+        if event is None:
+            # علامت توقف از stop_audit_writer
+            break
+        batch.append(event)
+    return batch
+
+def run_audit_writer():
+    """نخ پس‌زمینه نویسنده ممیزی
+
+    دسته‌ای که با خطای داده رد شود تا AUDIT_MAX_RETRIES بار دوباره نوشته می‌شود و سپس
+    نصف می‌شود تا ردیف‌های خراب کنار گذاشته شوند. با خطای اتصال دسته نگه داشته می‌شود و
+    با فاصله رو به افزایش دوباره تلاش می‌شود. پس از audit_stop باقی‌مانده صف را می‌نویسد و تمام می‌شود.
+    """
+    batch = []
+    failures = 0
+    while True:
+        stopping = audit_stop.is_set()
+        batch = drain_audit_queue(batch, 0 if stopping else AUDIT_FLUSH_SECONDS)
+        if not batch:
+            if stopping:
+                return
+            continue
+        
+        try:
+            write_audit_batch(batch)
+            batch, failures = [], 0
+            continue
+        except AUDIT_DATA_ERRORS as e:
+            data_error = True
+            print(f"خطا در ثبت رویدادهای ممیزی: {e}")
+        except Error as e:
+            data_error = False
+            print(f"خطا در ثبت رویدادهای ممیزی: {e}")
+        
+        failures += 1
+        if data_error and (stopping or failures >= AUDIT_MAX_RETRIES):
+            batch, failures = write_audit_rows(batch), 0
+        elif stopping:
+            print(f"{len(batch)} رویداد ممیزی ثبت نشد.")
+            batch, failures = [], 0
+        else:
+            audit_stop.wait(min(AUDIT_FLUSH_SECONDS * 2 ** (failures - 1), AUDIT_MAX_BACKOFF_SECONDS))
+
+def start_audit_writer():
+    global audit_writer
+    audit_stop.clear()
+    audit_writer = threading.Thread(target=run_audit_writer, daemon=True)
+    audit_writer.start()
+    atexit.register(stop_audit_writer)
+
+def stop_audit_writer(timeout=30):
+    """توقف نویسنده ممیزی و صبر تا نوشتن رویدادهای باقی‌مانده"""
+    audit_stop.set()
+    try:
+        audit_queue.put_nowait(None)
+    except queue.Full:
+        pass
+    if audit_writer is not None:
+        audit_writer.join(timeout)
+
+def handle_sigterm(signum, frame):
+    """تبدیل SIGTERM به خروج عادی تا atexit اجرا و صف ممیزی تخلیه شود"""
+    bot.stop_polling()
+    raise SystemExit(0)
 
 def create_tables():
-    conn = get_db_connection()
-    if conn is None:
-        return
     try:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS members (
-                id SERIAL PRIMARY KEY,
-                full_name VARCHAR NOT NULL,
-                phone VARCHAR,
-                email VARCHAR,
-                address TEXT,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            );
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS books (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR NOT NULL,
-                author VARCHAR NOT NULL,
-                isbn VARCHAR UNIQUE,
-                publication_year INTEGER,
-                total_copies INTEGER DEFAULT 1,
-                available_copies INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS borrowings (
-                id SERIAL PRIMARY KEY,
-                book_id INTEGER REFERENCES books(id) ON DELETE CASCADE,
-                member_id INTEGER REFERENCES members(id) ON DELETE CASCADE,
-                borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                due_date TIMESTAMP NOT NULL,
-                return_date TIMESTAMP,
-                is_returned BOOLEAN DEFAULT FALSE
-            );
-        """)
-        
-        conn.commit()
+        repo.create_schema()
         print("جداول با موفقیت ایجاد یا بررسی شدند.")
-        cur.close()
     except Error as e:
         print(f"خطا در ایجاد جداول: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+PERSIAN_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+ARABIC_LETTERS = str.maketrans({'ي': 'ی', 'ك': 'ک'})
+
+def normalize_digits(text):
+    """تبدیل ارقام فارسی و عربی به ارقام لاتین"""
+    return text.translate(PERSIAN_DIGITS)
+
+def normalize_name(text):
+    """یکسان‌سازی حروف عربی و فاصله‌ها در نام"""
+    return ' '.join(text.translate(ARABIC_LETTERS).split())
+
+def normalize_phone(text):
+    """نگه داشتن فقط ارقام شماره تلفن"""
+    return ''.join(ch for ch in normalize_digits(text) if ch.isdecimal())
+
+def looks_like_phone(text):
+    """آیا ورودی حتماً بخشی از شماره تلفن است و نمی‌تواند کد باشد
+
+    (صفر ابتدایی، جداکننده یا حداقل ۷ رقم)
+    """
+    text = normalize_digits(text.strip())
+    digits = normalize_phone(text)
+    if not digits:
+        return False
+    return not text.isdecimal() or text.startswith('0') or len(digits) >= 7
+
+def search_members(fragment, limit=MEMBER_SEARCH_LIMIT):
+    """جستجوی اعضای فعال با کد، بخشی از نام یا بخشی از شماره تلفن
+
+    خروجی: (لیست Member، آیا کد دقیق تنها نتیجه است) یا None در صورت خطا
+    """
+    fragment = normalize_digits(fragment.strip())
+    name = normalize_name(fragment).lower()
+    digits = normalize_phone(fragment)
+
+    # رشته کوتاه عددی می‌تواند هم کد عضو باشد و هم بخشی از تلفن؛ هر دو جستجو می‌شوند
+    phone_only = looks_like_phone(fragment)
+    member_id = int(fragment) if fragment.isdecimal() and not phone_only else None
+    if len(name) < MEMBER_SEARCH_MIN_LENGTH or fragment.isdecimal():
+        name = None
+    if len(digits) < MEMBER_SEARCH_MIN_LENGTH or not (phone_only or fragment.isdecimal()):
+        digits = None
+
+    try:
+        members = repo.search_members(member_id=member_id, name=name, phone=digits, limit=limit)
+    except Error as e:
+        print(f"خطا در جستجوی اعضا: {e}")
+        return None
+
+    # انتخاب خودکار فقط وقتی کد دقیق تنها نتیجه باشد
+    exact = len(members) == 1 and members[0].id == member_id
+    return members, exact
+
+def member_candidates_markup(members, callback_prefix):
+    """دکمه‌های انتخاب عضو از میان نتایج جستجو"""
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for member in members:
+        label = f"{member.full_name} - {member.phone or 'بدون تلفن'} (کد {member.id})"
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"{callback_prefix}:{member.id}"))
+    return markup
 
 def login_menu():
     """منوی لاگین"""
@@ -200,81 +361,52 @@ def send_welcome(message):
 
 @bot.message_handler(func=lambda message: message.text == 'نمایش کتاب‌ها')
 @login_required
+@query_budget
 def show_books(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
-        return
-    
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, title, author, available_copies, total_copies 
-            FROM books 
-            ORDER BY title
-        """)
-        books = cur.fetchall()
-        
+        books = repo.list_books()
+
         if not books:
             bot.send_message(message.chat.id, "هیچ کتابی در کتابخانه ثبت نشده است.")
             return
-        
+
         response = "لیست کتاب‌ها:\n\n"
         for book in books:
-            status = "موجود" if book[3] > 0 else "امانت"
-            response += f"{book[1]}\n"
-            response += f"نویسنده: {book[2]}\n"
-            response += f"موجودی: {book[3]}/{book[4]} - {status}\n"
-            response += f"کد کتاب: {book[0]}\n"
+            status = "موجود" if book.available_copies > 0 else "امانت"
+            response += f"{book.title}\n"
+            response += f"نویسنده: {book.author}\n"
+            response += f"موجودی: {book.available_copies}/{book.total_copies} - {status}\n"
+            response += f"کد کتاب: {book.id}\n"
             response += "-" * 30 + "\n"
-        
+
         bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
     except Error as e:
         bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'نمایش اعضا')
 @login_required
+@query_budget
 def show_members(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
-        return
-    
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, full_name, phone, email, join_date 
-            FROM members 
-            WHERE is_active = TRUE 
-            ORDER BY full_name
-        """)
-        members = cur.fetchall()
-        
+        members = repo.list_active_members()
+
         if not members:
             bot.send_message(message.chat.id, "هیچ عضوی ثبت نشده است.")
             return
-        
+
         response = "لیست اعضای کتابخانه:\n\n"
         for member in members:
-            join_date = member[4].strftime('%Y-%m-%d')
-            response += f"{member[1]}\n"
-            response += f"تلفن: {member[2] or 'ثبت نشده'}\n"
-            response += f"ایمیل: {member[3] or 'ثبت نشده'}\n"
+            join_date = member.join_date.strftime('%Y-%m-%d')
+            response += f"{member.full_name}\n"
+            response += f"تلفن: {member.phone or 'ثبت نشده'}\n"
+            response += f"ایمیل: {member.email or 'ثبت نشده'}\n"
             response += f"تاریخ عضویت: {join_date}\n"
-            response += f"کد عضو: {member[0]}\n"
+            response += f"کد عضو: {member.id}\n"
             response += "-" * 30 + "\n"
-        
+
         bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
     except Error as e:
         bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'اضافه کردن عضو')
 @login_required
@@ -285,7 +417,7 @@ def add_member_command(message):
 
 def process_member_name(message):
     chat_id = message.chat.id
-    full_name = message.text.strip()
+    full_name = normalize_name(message.text.strip())
     
     if not full_name or len(full_name) < 2:
         bot.send_message(chat_id, "نام وارد شده معتبر نیست. لطفاً دوباره تلاش کنید.")
@@ -296,7 +428,7 @@ def process_member_name(message):
 
 def process_member_phone(message, full_name):
     chat_id = message.chat.id
-    phone = message.text.strip() if message.text else None
+    phone = normalize_digits(message.text.strip()) if message.text else None
     
     msg = bot.send_message(chat_id, "لطفاً ایمیل عضو را وارد کنید:")
     bot.register_next_step_handler(msg, process_member_email, full_name, phone)
@@ -308,33 +440,19 @@ def process_member_email(message, full_name, phone):
     msg = bot.send_message(chat_id, "لطفاً آدرس عضو را وارد کنید:")
     bot.register_next_step_handler(msg, process_member_address, full_name, phone, email)
 
+@query_budget
 def process_member_address(message, full_name, phone, email):
     chat_id = message.chat.id
     address = message.text.strip() if message.text else None
-    
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
+
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO members (full_name, phone, email, address)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (full_name, phone, email, address))
-        
-        member_id = cur.fetchone()[0]
-        conn.commit()
-        
+        member_id = repo.add_member(full_name, phone, email, address)
+        audit(chat_id, 'add_member', 'member', member_id,
+              full_name=full_name, phone=phone, email=email, address=address)
+
         bot.send_message(chat_id, f"عضو جدید با موفقیت ثبت شد!\nکد عضویت: {member_id}")
-        cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در ثبت عضو: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'اضافه کردن کتاب')
 @login_required
@@ -379,34 +497,20 @@ def process_book_copies(message, title, author):
     msg = bot.send_message(chat_id, "لطفاً سال انتشار کتاب را وارد کنید (اختیاری):")
     bot.register_next_step_handler(msg, process_book_year, title, author, copies)
 
+@query_budget
 def process_book_year(message, title, author, copies):
     chat_id = message.chat.id
     year_text = message.text.strip()
     year = int(year_text) if year_text and year_text.isdigit() else None
-    
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
+
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO books (title, author, total_copies, available_copies, publication_year)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        """, (title, author, copies, copies, year))
-        
-        book_id = cur.fetchone()[0]
-        conn.commit()
-        
+        book_id = repo.add_book(title, author, copies, year)
+        audit(chat_id, 'add_book', 'book', book_id,
+              title=title, author=author, copies=copies, publication_year=year)
+
         bot.send_message(chat_id, f"کتاب جدید با موفقیت ثبت شد!\nکد کتاب: {book_id}")
-        cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در ثبت کتاب: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'امانت دادن کتاب')
 @login_required
@@ -419,144 +523,187 @@ def process_borrow_book_id(message):
     chat_id = message.chat.id
     book_id = message.text.strip()
     
-    if not book_id.isdigit():
+    if not book_id.isdecimal():
         bot.send_message(chat_id, "کد کتاب باید عدد باشد.")
         return
     
-    msg = bot.send_message(chat_id, "لطفاً کد عضو را وارد کنید:")
+    msg = bot.send_message(chat_id, "لطفاً کد عضو یا بخشی از نام یا شماره تلفن عضو را وارد کنید:")
     bot.register_next_step_handler(msg, process_borrow_member_id, int(book_id))
 
+@query_budget
 def process_borrow_member_id(message, book_id):
     chat_id = message.chat.id
-    member_id = message.text.strip()
-    
-    if not member_id.isdigit():
-        bot.send_message(chat_id, "کد عضو باید عدد باشد.")
+    fragment = message.text.strip() if message.text else ''
+
+    result = search_members(fragment)
+    if result is None:
+        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
         return
-    
+
+    members, exact = result
+    if exact:
+        ask_borrow_days(chat_id, book_id, members[0].id)
+        return
+
+    if not members:
+        bot.send_message(chat_id, f"عضوی با این مشخصات یافت نشد. حداقل {MEMBER_SEARCH_MIN_LENGTH} حرف از نام یا رقم از تلفن را وارد کنید.")
+        return
+
+    bot.send_message(chat_id, "عضو مورد نظر را انتخاب کنید:",
+                     reply_markup=member_candidates_markup(members, f"borrow_member:{book_id}"))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('borrow_member:'))
+def borrow_member_selected(call):
+    chat_id = call.message.chat.id
+    if not check_login(chat_id):
+        bot.answer_callback_query(call.id, "لطفاً ابتدا وارد سیستم شوید.")
+        return
+
+    _, book_id, member_id = call.data.split(':')
+    bot.answer_callback_query(call.id)
+    ask_borrow_days(chat_id, int(book_id), int(member_id))
+
+def ask_borrow_days(chat_id, book_id, member_id):
     msg = bot.send_message(chat_id, "برای چند روز امانت داده شود؟ (پیش‌فرض: 14 روز)")
-    bot.register_next_step_handler(msg, process_borrow_days, book_id, int(member_id))
+    bot.register_next_step_handler(msg, process_borrow_days, book_id, member_id)
 
+@query_budget
 def process_borrow_days(message, book_id, member_id):
     chat_id = message.chat.id
     days_text = message.text.strip()
-    
+
     try:
         days = int(days_text) if days_text else 14
         if days < 1:
             days = 14
     except:
         days = 14
-    
+
     due_date = datetime.now() + timedelta(days=days)
-    
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
+
     try:
-        cur = conn.cursor()
-        
-        cur.execute("SELECT available_copies, title FROM books WHERE id = %s", (book_id,))
-        book_info = cur.fetchone()
-        
-        if not book_info:
+        book = repo.get_book(book_id)
+
+        if not book:
             bot.send_message(chat_id, "کتابی با این کد یافت نشد.")
             return
-        
-        if book_info[0] < 1:
-            bot.send_message(chat_id, f"کتاب '{book_info[1]}' در حال حاضر موجود نیست.")
+
+        if book.available_copies < 1:
+            bot.send_message(chat_id, f"کتاب '{book.title}' در حال حاضر موجود نیست.")
             return
-        
-        cur.execute("SELECT full_name FROM members WHERE id = %s AND is_active = TRUE", (member_id,))
-        member_info = cur.fetchone()
-        
-        if not member_info:
+
+        member = repo.get_active_member(member_id)
+
+        if not member:
             bot.send_message(chat_id, "عضوی با این کد یافت نشد یا غیرفعال است.")
             return
-        
-        cur.execute("""
-            INSERT INTO borrowings (book_id, member_id, due_date)
-            VALUES (%s, %s, %s)
-        """, (book_id, member_id, due_date))
-        
-        cur.execute("""
-            UPDATE books 
-            SET available_copies = available_copies - 1 
-            WHERE id = %s
-        """, (book_id,))
-        
-        conn.commit()
-        
+
+        borrowing_id = repo.create_loan(book_id, member_id, due_date)
+
+        if borrowing_id is None:
+            bot.send_message(chat_id, f"کتاب '{book.title}' در حال حاضر موجود نیست.")
+            return
+
+        audit_loan(chat_id, 'borrow', borrowing_id, book_id, member_id, due_date=due_date)
+
         due_date_str = due_date.strftime('%Y-%m-%d')
-        bot.send_message(chat_id, f"کتاب '{book_info[1]}' به '{member_info[0]}' امانت داده شد.\nموعد بازگشت: {due_date_str}")
-        cur.close()
+        bot.send_message(chat_id, f"کتاب '{book.title}' به '{member.full_name}' امانت داده شد.\nموعد بازگشت: {due_date_str}")
     except Error as e:
         bot.send_message(chat_id, f"خطا در ثبت امانت: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'پس گرفتن کتاب')
 @login_required
 def return_book_command(message):
     chat_id = message.chat.id
-    msg = bot.send_message(chat_id, "لطفاً کد کتاب را وارد کنید:")
+    msg = bot.send_message(chat_id, "لطفاً کد کتاب یا بخشی از نام یا شماره تلفن امانت‌گیرنده را وارد کنید:")
     bot.register_next_step_handler(msg, process_return_book)
 
+@query_budget
 def process_return_book(message):
     chat_id = message.chat.id
-    book_id = message.text.strip()
+    text = normalize_digits(message.text.strip()) if message.text else ''
     
-    if not book_id.isdigit():
-        bot.send_message(chat_id, "کد کتاب باید عدد باشد.")
-        return
+    if text.isdecimal() and not looks_like_phone(text):
+        if complete_return(chat_id, book_id=int(text), report_missing=False):
+            return
+        # کتابی با این کد امانت فعال ندارد؛ شاید بخشی از تلفن امانت‌گیرنده باشد
     
-    conn = get_db_connection()
-    if conn is None:
+    result = search_members(text)
+    if result is None:
         bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
         return
     
+    members, _ = result
+    if not members and text.isdecimal():
+        bot.send_message(chat_id, "هیچ امانت فعالی برای این کتاب یافت نشد و عضوی با این شماره تلفن هم پیدا نشد.")
+        return
+    if not members:
+        bot.send_message(chat_id, f"عضوی با این مشخصات یافت نشد. حداقل {MEMBER_SEARCH_MIN_LENGTH} حرف از نام یا رقم از تلفن را وارد کنید.")
+        return
+    
+    bot.send_message(chat_id, "امانت‌گیرنده را انتخاب کنید:",
+                     reply_markup=member_candidates_markup(members, "return_member"))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('return_member:'))
+@query_budget
+def return_member_selected(call):
+    chat_id = call.message.chat.id
+    if not check_login(chat_id):
+        bot.answer_callback_query(call.id, "لطفاً ابتدا وارد سیستم شوید.")
+        return
+
+    member_id = int(call.data.split(':')[1])
+    bot.answer_callback_query(call.id)
+
     try:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT b.id, bk.title, m.full_name 
-            FROM borrowings b
-            JOIN books bk ON b.book_id = bk.id
-            JOIN members m ON b.member_id = m.id
-            WHERE b.book_id = %s AND b.is_returned = FALSE
-            ORDER BY b.borrow_date DESC LIMIT 1
-        """, (int(book_id),))
-        
-        borrowing = cur.fetchone()
-        
-        if not borrowing:
-            bot.send_message(chat_id, "هیچ امانت فعالی برای این کتاب یافت نشد.")
+        loans = repo.member_open_loans(member_id)
+
+        if not loans:
+            bot.send_message(chat_id, "این عضو هیچ امانت فعالی ندارد.")
             return
-        
-        cur.execute("""
-            UPDATE borrowings 
-            SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP 
-            WHERE id = %s
-        """, (borrowing[0],))
-        
-        cur.execute("""
-            UPDATE books 
-            SET available_copies = available_copies + 1 
-            WHERE id = %s
-        """, (int(book_id),))
-        
-        conn.commit()
-        
-        bot.send_message(chat_id, f"کتاب '{borrowing[1]}' از '{borrowing[2]}' پس گرفته شد.")
-        cur.close()
+
+        markup = types.InlineKeyboardMarkup(row_width=1)
+        for loan in loans:
+            label = f"{loan.title} - موعد: {loan.due_date.strftime('%Y-%m-%d')}"
+            markup.add(types.InlineKeyboardButton(label, callback_data=f"return_loan:{loan.id}"))
+
+        bot.send_message(chat_id, "کتابی که پس گرفته می‌شود را انتخاب کنید:", reply_markup=markup)
+    except Error as e:
+        bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('return_loan:'))
+@query_budget
+def return_loan_selected(call):
+    chat_id = call.message.chat.id
+    if not check_login(chat_id):
+        bot.answer_callback_query(call.id, "لطفاً ابتدا وارد سیستم شوید.")
+        return
+    
+    bot.answer_callback_query(call.id)
+    complete_return(chat_id, borrowing_id=int(call.data.split(':')[1]))
+
+def complete_return(chat_id, book_id=None, borrowing_id=None, report_missing=True):
+    """ثبت بازگشت آخرین امانت فعال یک کتاب یا یک امانت مشخص
+
+    خروجی: False اگر امانت فعالی پیدا نشد (پیام فقط با report_missing فرستاده می‌شود)
+    """
+    try:
+        if borrowing_id is not None:
+            loan = repo.get_open_loan(borrowing_id)
+        else:
+            loan = repo.latest_open_loan_for_book(book_id)
+
+        if not loan or not repo.close_loan(loan):
+            if report_missing:
+                bot.send_message(chat_id, "هیچ امانت فعالی برای این کتاب یافت نشد.")
+            return False
+
+        audit_loan(chat_id, 'return', loan.id, loan.book_id, loan.member_id)
+
+        bot.send_message(chat_id, f"کتاب '{loan.title}' از '{loan.full_name}' پس گرفته شد.")
     except Error as e:
         bot.send_message(chat_id, f"خطا در پس گرفتن کتاب: {e}")
-    finally:
-        if conn:
-            conn.close()
+    return True
 
 @bot.message_handler(func=lambda message: message.text == 'جستجوی کتاب')
 @login_required
@@ -571,46 +718,29 @@ def search_by_title_command(message):
     msg = bot.send_message(chat_id, "لطفاً بخشی از عنوان کتاب را وارد کنید:")
     bot.register_next_step_handler(msg, search_by_title)
 
+@query_budget
 def search_by_title(message):
     chat_id = message.chat.id
-    keyword = f"%{message.text.strip()}%"
-    
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
+
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, title, author, available_copies 
-            FROM books 
-            WHERE title ILIKE %s 
-            ORDER BY title
-        """, (keyword,))
-        
-        books = cur.fetchall()
-        
+        books = repo.search_books(title=message.text.strip())
+
         if not books:
             bot.send_message(chat_id, "کتابی با این عنوان یافت نشد.")
             return
-        
+
         response = f"نتایج جستجو برای '{message.text.strip()}':\n\n"
         for book in books:
-            status = "موجود" if book[3] > 0 else "امانت"
-            response += f"{book[1]}\n"
-            response += f"نویسنده: {book[2]}\n"
+            status = "موجود" if book.available_copies > 0 else "امانت"
+            response += f"{book.title}\n"
+            response += f"نویسنده: {book.author}\n"
             response += f"وضعیت: {status}\n"
-            response += f"کد کتاب: {book[0]}\n"
+            response += f"کد کتاب: {book.id}\n"
             response += "-" * 30 + "\n"
-        
+
         bot.send_message(chat_id, response, parse_mode='Markdown')
-        cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در جستجو: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'جستجو با نویسنده')
 @login_required
@@ -619,101 +749,163 @@ def search_by_author_command(message):
     msg = bot.send_message(chat_id, "لطفاً نام نویسنده را وارد کنید:")
     bot.register_next_step_handler(msg, search_by_author)
 
+@query_budget
 def search_by_author(message):
     chat_id = message.chat.id
-    keyword = f"%{message.text.strip()}%"
-    
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(chat_id, "خطا در اتصال به پایگاه داده.")
-        return
-    
+
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, title, author, available_copies 
-            FROM books 
-            WHERE author ILIKE %s 
-            ORDER BY title
-        """, (keyword,))
-        
-        books = cur.fetchall()
-        
+        books = repo.search_books(author=message.text.strip())
+
         if not books:
             bot.send_message(chat_id, "کتابی از این نویسنده یافت نشد.")
             return
-        
+
         response = f"نتایج جستجو برای نویسنده '{message.text.strip()}':\n\n"
         for book in books:
-            status = "موجود" if book[3] > 0 else "امانت"
-            response += f"{book[1]}\n"
-            response += f"نویسنده: {book[2]}\n"
+            status = "موجود" if book.available_copies > 0 else "امانت"
+            response += f"{book.title}\n"
+            response += f"نویسنده: {book.author}\n"
             response += f"وضعیت: {status}\n"
-            response += f"کد کتاب: {book[0]}\n"
+            response += f"کد کتاب: {book.id}\n"
             response += "-" * 30 + "\n"
-        
+
         bot.send_message(chat_id, response, parse_mode='Markdown')
-        cur.close()
     except Error as e:
         bot.send_message(chat_id, f"خطا در جستجو: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 @bot.message_handler(func=lambda message: message.text == 'وضعیت کتاب‌های امانت‌رفته')
 @login_required
+@query_budget
 def show_borrowed_books(message):
-    conn = get_db_connection()
-    if conn is None:
-        bot.send_message(message.chat.id, "خطا در اتصال به پایگاه داده.")
-        return
-    
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT 
-                b.title,
-                bk.author,
-                m.full_name,
-                br.borrow_date,
-                br.due_date,
-                CASE 
-                    WHEN br.due_date < CURRENT_DATE THEN 'معوقه'
-                    ELSE 'در امانت'
-                END as status
-            FROM borrowings br
-            JOIN books b ON br.book_id = b.id
-            JOIN members m ON br.member_id = m.id
-            JOIN books bk ON br.book_id = bk.id
-            WHERE br.is_returned = FALSE
-            ORDER BY br.due_date
-        """)
-        
-        borrowed = cur.fetchall()
-        
+        borrowed = repo.open_loans()
+
         if not borrowed:
             bot.send_message(message.chat.id, "هیچ کتابی در حال حاضر امانت نیست.")
             return
-        
+
+        today = date.today()
         response = "کتاب‌های در حال امانت:\n\n"
         for item in borrowed:
-            borrow_date = item[3].strftime('%Y-%m-%d')
-            due_date = item[4].strftime('%Y-%m-%d')
-            response += f"{item[0]}\n"
-            response += f"نویسنده: {item[1]}\n"
-            response += f"امانت گیرنده: {item[2]}\n"
+            borrow_date = item.borrow_date.strftime('%Y-%m-%d')
+            due_date = item.due_date.strftime('%Y-%m-%d')
+            status = 'معوقه' if item.due_date.date() < today else 'در امانت'
+            response += f"{item.title}\n"
+            response += f"نویسنده: {item.author}\n"
+            response += f"امانت گیرنده: {item.full_name}\n"
             response += f"تاریخ امانت: {borrow_date}\n"
             response += f"موعد بازگشت: {due_date}\n"
-            response += f"وضعیت: {item[5]}\n"
+            response += f"وضعیت: {status}\n"
             response += "-" * 30 + "\n"
-        
+
         bot.send_message(message.chat.id, response, parse_mode='Markdown')
-        cur.close()
     except Error as e:
         bot.send_message(message.chat.id, f"خطا در دریافت اطلاعات: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+def reconcile_available_copies(chat_id=None, batch_size=RECONCILE_BATCH_SIZE):
+    """هم‌خوان کردن available_copies با تعداد امانت‌های باز
+
+    ناهمخوانی‌ها در یک پیمایش روی ایندکس امانت‌های باز پیدا می‌شوند و در
+    دسته‌های کوچک با تراکنش‌های کوتاه اصلاح می‌شوند. هر دسته ردیف‌های کتاب را
+    قفل می‌کند و پس از آن مقدار درست را دوباره محاسبه می‌کند (fix_stock_drift).
+    کتاب‌هایی که بیش از total_copies امانت رفته‌اند گزارش می‌شوند و موجودی آن‌ها صفر می‌شود.
+    خروجی: (لیست StockDrift، تعداد اصلاح‌شده) یا None در صورت خطا
+    """
+    try:
+        discrepancies = repo.stock_drift()
+    except Error as e:
+        print(f"خطا در بررسی موجودی کتاب‌ها: {e}")
+        return None
+
+    fixed = 0
+    book_ids = [row.book_id for row in discrepancies]
+    for start in range(0, len(book_ids), batch_size):
+        batch = book_ids[start:start + batch_size]
+        try:
+            updated = repo.fix_stock_drift(batch)
+        except Error as e:
+            print(f"خطا در اصلاح موجودی کتاب‌های {batch[0]} تا {batch[-1]}: {e}")
+            continue
+        fixed += len(updated)
+        for book_id, available in updated:
+            audit(chat_id, 'reconcile', 'book', book_id, available_copies=available)
+
+    return discrepancies, fixed
+
+def format_reconcile_report(discrepancies, fixed):
+    if not discrepancies:
+        return "موجودی همه کتاب‌ها با امانت‌های باز هم‌خوان است."
+
+    response = f"ناهمخوانی موجودی در {len(discrepancies)} کتاب ({fixed} مورد اصلاح شد):\n\n"
+    for book in discrepancies[:50]:
+        response += f"{book.title} (کد {book.book_id})\n"
+        response += f"ثبت‌شده: {book.available_copies} - واقعی: {max(book.expected, 0)}\n"
+        if book.expected < 0:
+            response += f"هشدار: {-book.expected} امانت بیش از تعداد نسخه‌ها\n"
+        response += "-" * 30 + "\n"
+    if len(discrepancies) > 50:
+        response += f"و {len(discrepancies) - 50} مورد دیگر..."
+    return response
+
+@bot.message_handler(commands=['reconcile'])
+@login_required
+def reconcile_command(message):
+    chat_id = message.chat.id
+    bot.send_message(chat_id, "در حال بررسی موجودی کتاب‌ها...")
+    
+    result = reconcile_available_copies(chat_id)
+    if result is None:
+        bot.send_message(chat_id, "خطا در بررسی موجودی کتاب‌ها.")
+        return
+    
+    bot.send_message(chat_id, format_reconcile_report(*result))
+
+def run_scheduled_reconcile():
+    """یک اجرای زمان‌بندی‌شده؛ هر خطایی چاپ می‌شود تا نخ زمان‌بند از کار نیفتد"""
+    try:
+        result = reconcile_available_copies()
+        if result is not None:
+            print(format_reconcile_report(*result))
+    except Exception as e:
+        print(f"خطا در هم‌خوان‌سازی زمان‌بندی‌شده موجودی: {e}")
+
+def run_reconcile_scheduler():
+    """اجرای دوره‌ای هم‌خوان‌سازی موجودی"""
+    while True:
+        time.sleep(RECONCILE_INTERVAL_HOURS * 3600)
+        run_scheduled_reconcile()
+
+AUDIT_ENTITY_TYPES = ('book', 'member', 'borrowing')
+
+@bot.message_handler(commands=['audit'])
+@login_required
+@query_budget
+def show_audit_log(message):
+    """نمایش تاریخچه تغییرات یک موجودیت: /audit book 12"""
+    chat_id = message.chat.id
+    args = message.text.split()[1:]
+
+    if len(args) != 2 or args[0] not in AUDIT_ENTITY_TYPES or not args[1].isdecimal():
+        bot.send_message(chat_id, "نحوه استفاده: /audit book|member|borrowing <کد>")
+        return
+
+    try:
+        entries = repo.audit_entries(args[0], int(args[1]))
+
+        if not entries:
+            bot.send_message(chat_id, "هیچ رویدادی برای این مورد ثبت نشده است.")
+            return
+
+        response = f"تاریخچه {args[0]} {args[1]}:\n\n"
+        for entry in entries:
+            response += f"{entry.created_at.strftime('%Y-%m-%d %H:%M')} - {entry.action}\n"
+            response += f"کاربر: {entry.chat_id or 'سیستم'}\n"
+            response += f"{json.dumps(entry.payload, ensure_ascii=False)}\n"
+            response += "-" * 30 + "\n"
+
+        bot.send_message(chat_id, response)
+    except Error as e:
+        bot.send_message(chat_id, f"خطا در دریافت اطلاعات: {e}")
 
 @bot.message_handler(func=lambda message: message.text == 'بازگشت به منوی اصلی')
 @login_required
@@ -722,6 +914,10 @@ def back_to_main_menu(message):
 
 if __name__ == '__main__':
     create_tables()
+    start_audit_writer()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if RECONCILE_INTERVAL_HOURS > 0:
+        threading.Thread(target=run_reconcile_scheduler, daemon=True).start()
     print("Running .....")
 
     bot.polling(none_stop=True)
@@ -0,0 +1,672 @@
+"""لایه دسترسی به داده برای کتاب‌ها، اعضا و امانت‌ها
+
+ردیف‌ها به صورت namedtuple برگردانده می‌شوند. PostgresRepository روی پایگاه داده
+کار می‌کند و InMemoryRepository همان رابط را برای تست و بنچمارک در حافظه پیاده می‌کند.
+هر کوئری در query_counter شمرده می‌شود تا هزینه هر به‌روزرسانی قابل اندازه‌گیری باشد.
+"""
+import itertools
+import json
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import psycopg2
+from psycopg2 import Error
+from psycopg2.extras import execute_values
+
+
+Book = namedtuple('Book', 'id title author available_copies total_copies')
+Member = namedtuple('Member', 'id full_name phone email join_date')
+Loan = namedtuple('Loan', 'id book_id member_id title author full_name borrow_date due_date')
+StockDrift = namedtuple('StockDrift', 'book_id title available_copies expected')  # expected منفی: امانت بیش از total_copies
+AuditEntry = namedtuple('AuditEntry', 'created_at chat_id action payload')
+
+
+class QueryCounter(threading.local):
+    """شمارنده کوئری‌ها برای هر نخ؛ فقط بیرونی‌ترین begin/end شمارش را صفر و گزارش می‌کند"""
+
+    def __init__(self):
+        self.count = 0
+        self.depth = 0
+
+    def begin(self):
+        if self.depth == 0:
+            self.count = 0
+        self.depth += 1
+
+    def end(self):
+        """پایان یک بازه؛ برای بازه بیرونی تعداد کوئری‌ها و در غیر این صورت None"""
+        self.depth -= 1
+        return self.count if self.depth == 0 else None
+
+
+query_counter = QueryCounter()
+
+
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class PostgresRepository:
+    """دسترسی به داده روی PostgreSQL با یک اتصال ماندگار برای هر نخ"""
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = psycopg2.connect(self.dsn)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """یک تراکنش کوتاه؛ در صورت خطا rollback و در صورت قطع اتصال، اتصال دور ریخته می‌شود"""
+        conn = self._connection()
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except BaseException:
+            # هر خطایی (نه فقط Error) باید rollback شود وگرنه تراکنش باز روی اتصال ماندگار
+            # می‌ماند و با commit عملیات بعدی ثبت می‌شود
+            if conn.closed:
+                self._local.conn = None
+            else:
+                conn.rollback()
+            raise
+
+    def _execute(self, cur, sql, params=None):
+        query_counter.count += 1
+        cur.execute(sql, params)
+
+    def create_schema(self):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                CREATE TABLE IF NOT EXISTS members (
+                    id SERIAL PRIMARY KEY,
+                    full_name VARCHAR NOT NULL,
+                    phone VARCHAR,
+                    email VARCHAR,
+                    address TEXT,
+                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    is_active BOOLEAN DEFAULT TRUE
+                );
+            """)
+
+            self._execute(cur, """
+                CREATE TABLE IF NOT EXISTS books (
+                    id SERIAL PRIMARY KEY,
+                    title VARCHAR NOT NULL,
+                    author VARCHAR NOT NULL,
+                    isbn VARCHAR UNIQUE,
+                    publication_year INTEGER,
+                    total_copies INTEGER DEFAULT 1,
+                    available_copies INTEGER DEFAULT 1,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+
+            self._execute(cur, """
+                CREATE TABLE IF NOT EXISTS borrowings (
+                    id SERIAL PRIMARY KEY,
+                    book_id INTEGER REFERENCES books(id) ON DELETE CASCADE,
+                    member_id INTEGER REFERENCES members(id) ON DELETE CASCADE,
+                    borrow_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    due_date TIMESTAMP NOT NULL,
+                    return_date TIMESTAMP,
+                    is_returned BOOLEAN DEFAULT FALSE
+                );
+            """)
+
+            # یکسان‌سازی ردیف‌های قدیمی مانند ورودی‌های جدید: حروف عربی و ارقام فارسی
+            self._execute(cur, """
+                UPDATE members
+                SET full_name = translate(full_name, 'يك', 'یک')
+                WHERE full_name ~ '[يك]';
+            """)
+            self._execute(cur, """
+                UPDATE members
+                SET phone = translate(phone, '۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+                WHERE phone ~ '[۰-۹٠-٩]';
+            """)
+
+            # ایندکس‌های سه‌حرفی برای جستجوی عضو با بخشی از نام یا تلفن
+            self._execute(cur, "CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            self._execute(cur, """
+                CREATE INDEX IF NOT EXISTS members_full_name_trgm_idx
+                ON members USING gin (lower(full_name) gin_trgm_ops)
+                WHERE is_active = TRUE;
+            """)
+            self._execute(cur, """
+                CREATE INDEX IF NOT EXISTS members_phone_trgm_idx
+                ON members USING gin (regexp_replace(phone, '[^0-9]', '', 'g') gin_trgm_ops)
+                WHERE is_active = TRUE;
+            """)
+
+            # ایندکس امانت‌های باز برای شمارش موجودی واقعی
+            self._execute(cur, """
+                CREATE INDEX IF NOT EXISTS borrowings_open_book_idx
+                ON borrowings (book_id)
+                WHERE is_returned = FALSE;
+            """)
+
+            self._execute(cur, """
+                CREATE TABLE IF NOT EXISTS audit_log (
+                    id BIGSERIAL PRIMARY KEY,
+                    chat_id BIGINT,
+                    action VARCHAR NOT NULL,
+                    entity_type VARCHAR NOT NULL,
+                    entity_id INTEGER,
+                    payload JSONB,
+                    created_at TIMESTAMP NOT NULL
+                );
+            """)
+            self._execute(cur, """
+                CREATE INDEX IF NOT EXISTS audit_log_entity_idx
+                ON audit_log (entity_type, entity_id, created_at);
+            """)
+            self._execute(cur, """
+                CREATE INDEX IF NOT EXISTS audit_log_created_at_idx
+                ON audit_log USING brin (created_at);
+            """)
+
+    # کتاب‌ها
+
+    def list_books(self):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT id, title, author, available_copies, total_copies
+                FROM books
+                ORDER BY title
+            """)
+            return [Book(*row) for row in cur.fetchall()]
+
+    def search_books(self, title=None, author=None):
+        """جستجوی کتاب با بخشی از عنوان یا نام نویسنده (بدون حساسیت به حروف)"""
+        column, keyword = ('title', title) if title is not None else ('author', author)
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT id, title, author, available_copies, total_copies
+                FROM books
+                WHERE {column} ILIKE %s
+                ORDER BY title
+            """, (f"%{keyword}%",))
+            return [Book(*row) for row in cur.fetchall()]
+
+    def get_book(self, book_id):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT id, title, author, available_copies, total_copies
+                FROM books
+                WHERE id = %s
+            """, (book_id,))
+            row = cur.fetchone()
+            return Book(*row) if row else None
+
+    def add_book(self, title, author, copies, publication_year):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                INSERT INTO books (title, author, total_copies, available_copies, publication_year)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+            """, (title, author, copies, copies, publication_year))
+            return cur.fetchone()[0]
+
+    # اعضا
+
+    def list_active_members(self):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT id, full_name, phone, email, join_date
+                FROM members
+                WHERE is_active = TRUE
+                ORDER BY full_name
+            """)
+            return [Member(*row) for row in cur.fetchall()]
+
+    def get_active_member(self, member_id):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT id, full_name, phone, email, join_date
+                FROM members
+                WHERE id = %s AND is_active = TRUE
+            """, (member_id,))
+            row = cur.fetchone()
+            return Member(*row) if row else None
+
+    def search_members(self, member_id=None, name=None, phone=None, limit=8):
+        """جستجوی اعضای فعال با کد دقیق، بخشی از نام (حروف کوچک) یا بخشی از ارقام تلفن
+
+        فقط از ایندکس‌ها استفاده می‌کند؛ کد دقیق و سپس تطابق ابتدای نام در اول نتایج می‌آیند.
+        """
+        conditions = []
+        params = {'id': member_id, 'prefix': escape_like(name or '') + '%', 'limit': limit}
+        if member_id is not None:
+            conditions.append("id = %(id)s")
+        if name:
+            conditions.append("lower(full_name) LIKE %(name)s")
+            params['name'] = '%' + escape_like(name) + '%'
+        if phone:
+            conditions.append("regexp_replace(phone, '[^0-9]', '', 'g') LIKE %(phone)s")
+            params['phone'] = '%' + escape_like(phone) + '%'
+
+        if not conditions:
+            return []
+
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT id, full_name, phone, email, join_date
+                FROM members
+                WHERE is_active = TRUE AND ({' OR '.join(conditions)})
+                ORDER BY id = %(id)s DESC NULLS LAST,
+                         lower(full_name) LIKE %(prefix)s DESC,
+                         full_name
+                LIMIT %(limit)s
+            """, params)
+            return [Member(*row) for row in cur.fetchall()]
+
+    def add_member(self, full_name, phone, email, address):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                INSERT INTO members (full_name, phone, email, address)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (full_name, phone, email, address))
+            return cur.fetchone()[0]
+
+    # امانت‌ها
+
+    _LOAN_COLUMNS = """
+        br.id, br.book_id, br.member_id, bk.title, bk.author, m.full_name,
+        br.borrow_date, br.due_date
+    """
+
+    def open_loans(self):
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT {self._LOAN_COLUMNS}
+                FROM borrowings br
+                JOIN books bk ON br.book_id = bk.id
+                JOIN members m ON br.member_id = m.id
+                WHERE br.is_returned = FALSE
+                ORDER BY br.due_date
+            """)
+            return [Loan(*row) for row in cur.fetchall()]
+
+    def member_open_loans(self, member_id):
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT {self._LOAN_COLUMNS}
+                FROM borrowings br
+                JOIN books bk ON br.book_id = bk.id
+                JOIN members m ON br.member_id = m.id
+                WHERE br.member_id = %s AND br.is_returned = FALSE
+                ORDER BY br.due_date
+            """, (member_id,))
+            return [Loan(*row) for row in cur.fetchall()]
+
+    def latest_open_loan_for_book(self, book_id):
+        """آخرین امانت باز یک کتاب"""
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT {self._LOAN_COLUMNS}
+                FROM borrowings br
+                JOIN books bk ON br.book_id = bk.id
+                JOIN members m ON br.member_id = m.id
+                WHERE br.book_id = %s AND br.is_returned = FALSE
+                ORDER BY br.borrow_date DESC LIMIT 1
+            """, (book_id,))
+            row = cur.fetchone()
+            return Loan(*row) if row else None
+
+    def get_open_loan(self, loan_id):
+        """یک امانت مشخص، اگر هنوز باز باشد"""
+        with self._transaction() as cur:
+            self._execute(cur, f"""
+                SELECT {self._LOAN_COLUMNS}
+                FROM borrowings br
+                JOIN books bk ON br.book_id = bk.id
+                JOIN members m ON br.member_id = m.id
+                WHERE br.id = %s AND br.is_returned = FALSE
+            """, (loan_id,))
+            row = cur.fetchone()
+            return Loan(*row) if row else None
+
+    def create_loan(self, book_id, member_id, due_date):
+        """ثبت امانت و کم کردن موجودی در یک تراکنش؛ اگر نسخه‌ای موجود نباشد None"""
+        with self._transaction() as cur:
+            self._execute(cur, """
+                UPDATE books
+                SET available_copies = available_copies - 1
+                WHERE id = %s AND available_copies > 0
+                RETURNING id
+            """, (book_id,))
+            if cur.fetchone() is None:
+                return None
+
+            self._execute(cur, """
+                INSERT INTO borrowings (book_id, member_id, due_date)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """, (book_id, member_id, due_date))
+            return cur.fetchone()[0]
+
+    def close_loan(self, loan):
+        """ثبت بازگشت امانت و افزایش موجودی در یک تراکنش؛ اگر قبلاً بسته شده باشد False"""
+        with self._transaction() as cur:
+            self._execute(cur, """
+                UPDATE borrowings
+                SET is_returned = TRUE, return_date = CURRENT_TIMESTAMP
+                WHERE id = %s AND is_returned = FALSE
+            """, (loan.id,))
+            if cur.rowcount == 0:
+                return False
+
+            self._execute(cur, """
+                UPDATE books
+                SET available_copies = available_copies + 1
+                WHERE id = %s
+            """, (loan.book_id,))
+            return True
+
+    # هم‌خوانی موجودی
+
+    def stock_drift(self):
+        """کتاب‌هایی که available_copies آن‌ها با total_copies منهای امانت‌های باز نمی‌خواند
+
+        expected محدود نمی‌شود تا کتاب‌هایی که بیش از نسخه‌هایشان امانت رفته‌اند هم گزارش شوند.
+        """
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT bk.id, bk.title, bk.available_copies,
+                       bk.total_copies - COALESCE(o.open_count, 0) AS expected
+                FROM books bk
+                LEFT JOIN (
+                    SELECT book_id, COUNT(*) AS open_count
+                    FROM borrowings
+                    WHERE is_returned = FALSE
+                    GROUP BY book_id
+                ) o ON o.book_id = bk.id
+                WHERE bk.available_copies IS DISTINCT FROM
+                      bk.total_copies - COALESCE(o.open_count, 0)
+                ORDER BY bk.id
+            """)
+            return [StockDrift(*row) for row in cur.fetchall()]
+
+    def fix_stock_drift(self, book_ids):
+        """اصلاح موجودی یک دسته کتاب با محاسبه دوباره؛ خروجی: لیست (book_id, available_copies)
+
+        ابتدا ردیف‌های کتاب قفل می‌شوند. امانت و بازگشت هم‌زمان پیش از آزاد کردن
+        همین قفل commit می‌شوند، پس UPDATE بعدی که snapshot تازه می‌گیرد
+        تعداد امانت‌های باز را درست می‌بیند و کاهش موجودی آن‌ها را برنمی‌گرداند.
+        """
+        book_ids = sorted(book_ids)
+        with self._transaction() as cur:
+            self._execute(cur, "SET LOCAL lock_timeout = '2s'")
+            self._execute(cur, """
+                SELECT id FROM books
+                WHERE id = ANY(%s::int[])
+                ORDER BY id
+                FOR UPDATE
+            """, (book_ids,))
+            self._execute(cur, """
+                UPDATE books bk
+                SET available_copies = GREATEST(bk.total_copies - COALESCE(o.open_count, 0), 0)
+                FROM unnest(%s::int[]) AS ids(id)
+                LEFT JOIN (
+                    SELECT book_id, COUNT(*) AS open_count
+                    FROM borrowings
+                    WHERE is_returned = FALSE AND book_id = ANY(%s::int[])
+                    GROUP BY book_id
+                ) o ON o.book_id = ids.id
+                WHERE bk.id = ids.id
+                  AND bk.available_copies IS DISTINCT FROM
+                      GREATEST(bk.total_copies - COALESCE(o.open_count, 0), 0)
+                RETURNING bk.id, bk.available_copies
+            """, (book_ids, book_ids))
+            return cur.fetchall()
+
+    # ممیزی
+
+    def insert_audit_batch(self, batch, page_size=200):
+        """نوشتن رویدادهای (chat_id, action, entity_type, entity_id, payload_json, created_at) با INSERT چندردیفی"""
+        with self._transaction() as cur:
+            query_counter.count += 1
+            execute_values(cur, """
+                INSERT INTO audit_log (chat_id, action, entity_type, entity_id, payload, created_at)
+                VALUES %s
+            """, batch, page_size=page_size)
+
+    def audit_entries(self, entity_type, entity_id, limit=20):
+        with self._transaction() as cur:
+            self._execute(cur, """
+                SELECT created_at, chat_id, action, payload
+                FROM audit_log
+                WHERE entity_type = %s AND entity_id = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (entity_type, entity_id, limit))
+            return [AuditEntry(*row) for row in cur.fetchall()]
+
+
+class InMemoryRepository:
+    """پیاده‌سازی درون‌حافظه‌ای همان رابط برای تست و بنچمارک
+
+    هر متد به همان تعداد دستوری که PostgresRepository اجرا می‌کند کوئری می‌شمارد.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._books = {}
+        self._members = {}
+        self._loans = {}
+        self._audit_log = []
+        self._book_ids = itertools.count(1)
+        self._member_ids = itertools.count(1)
+        self._loan_ids = itertools.count(1)
+
+    def _query(self, statements=1):
+        query_counter.count += statements
+
+    def create_schema(self):
+        self._query(12)
+
+    # کتاب‌ها
+
+    def _book_row(self, book):
+        return Book(book['id'], book['title'], book['author'],
+                    book['available_copies'], book['total_copies'])
+
+    def list_books(self):
+        self._query()
+        with self._lock:
+            books = sorted(self._books.values(), key=lambda book: book['title'])
+            return [self._book_row(book) for book in books]
+
+    def search_books(self, title=None, author=None):
+        self._query()
+        column, keyword = ('title', title) if title is not None else ('author', author)
+        keyword = keyword.lower()
+        with self._lock:
+            books = sorted(self._books.values(), key=lambda book: book['title'])
+            return [self._book_row(book) for book in books if keyword in book[column].lower()]
+
+    def get_book(self, book_id):
+        self._query()
+        with self._lock:
+            book = self._books.get(book_id)
+            return self._book_row(book) if book else None
+
+    def add_book(self, title, author, copies, publication_year):
+        self._query()
+        with self._lock:
+            book_id = next(self._book_ids)
+            self._books[book_id] = {
+                'id': book_id, 'title': title, 'author': author,
+                'publication_year': publication_year,
+                'total_copies': copies, 'available_copies': copies,
+            }
+            return book_id
+
+    # اعضا
+
+    def _member_row(self, member):
+        return Member(member['id'], member['full_name'], member['phone'],
+                      member['email'], member['join_date'])
+
+    def list_active_members(self):
+        self._query()
+        with self._lock:
+            members = sorted((m for m in self._members.values() if m['is_active']),
+                             key=lambda member: member['full_name'])
+            return [self._member_row(member) for member in members]
+
+    def get_active_member(self, member_id):
+        self._query()
+        with self._lock:
+            member = self._members.get(member_id)
+            return self._member_row(member) if member and member['is_active'] else None
+
+    def search_members(self, member_id=None, name=None, phone=None, limit=8):
+        if member_id is None and not name and not phone:
+            return []
+
+        self._query()
+
+        def matches(member):
+            digits = ''.join(ch for ch in member['phone'] or '' if ch.isdigit())
+            return (member['id'] == member_id
+                    or (name and name in member['full_name'].lower())
+                    or (phone and phone in digits))
+
+        def rank(member):
+            return (member['id'] != member_id,
+                    not (name and member['full_name'].lower().startswith(name)),
+                    member['full_name'])
+
+        with self._lock:
+            found = sorted((m for m in self._members.values() if m['is_active'] and matches(m)), key=rank)
+            return [self._member_row(member) for member in found[:limit]]
+
+    def add_member(self, full_name, phone, email, address):
+        self._query()
+        with self._lock:
+            member_id = next(self._member_ids)
+            self._members[member_id] = {
+                'id': member_id, 'full_name': full_name, 'phone': phone,
+                'email': email, 'address': address,
+                'join_date': datetime.now(), 'is_active': True,
+            }
+            return member_id
+
+    # امانت‌ها
+
+    def _loan_row(self, loan):
+        book = self._books[loan['book_id']]
+        member = self._members[loan['member_id']]
+        return Loan(loan['id'], loan['book_id'], loan['member_id'], book['title'],
+                    book['author'], member['full_name'], loan['borrow_date'], loan['due_date'])
+
+    def _open_loans(self, predicate):
+        loans = (loan for loan in self._loans.values() if not loan['is_returned'] and predicate(loan))
+        return [self._loan_row(loan) for loan in sorted(loans, key=lambda loan: loan['due_date'])]
+
+    def open_loans(self):
+        self._query()
+        with self._lock:
+            return self._open_loans(lambda loan: True)
+
+    def member_open_loans(self, member_id):
+        self._query()
+        with self._lock:
+            return self._open_loans(lambda loan: loan['member_id'] == member_id)
+
+    def latest_open_loan_for_book(self, book_id):
+        self._query()
+        with self._lock:
+            loans = self._open_loans(lambda loan: loan['book_id'] == book_id)
+            return max(loans, key=lambda loan: (loan.borrow_date, loan.id)) if loans else None
+
+    def get_open_loan(self, loan_id):
+        self._query()
+        with self._lock:
+            loans = self._open_loans(lambda loan: loan['id'] == loan_id)
+            return loans[0] if loans else None
+
+    def create_loan(self, book_id, member_id, due_date):
+        self._query()
+        with self._lock:
+            book = self._books.get(book_id)
+            if not book or book['available_copies'] < 1:
+                return None
+            self._query()
+            book['available_copies'] -= 1
+            loan_id = next(self._loan_ids)
+            self._loans[loan_id] = {
+                'id': loan_id, 'book_id': book_id, 'member_id': member_id,
+                'borrow_date': datetime.now(), 'due_date': due_date,
+                'return_date': None, 'is_returned': False,
+            }
+            return loan_id
+
+    def close_loan(self, loan):
+        self._query()
+        with self._lock:
+            record = self._loans.get(loan.id)
+            if not record or record['is_returned']:
+                return False
+            self._query()
+            record['is_returned'] = True
+            record['return_date'] = datetime.now()
+            self._books[record['book_id']]['available_copies'] += 1
+            return True
+
+    # هم‌خوانی موجودی
+
+    def _expected_copies(self):
+        open_counts = {}
+        for loan in self._loans.values():
+            if not loan['is_returned']:
+                open_counts[loan['book_id']] = open_counts.get(loan['book_id'], 0) + 1
+        return {book_id: book['total_copies'] - open_counts.get(book_id, 0)
+                for book_id, book in self._books.items()}
+
+    def stock_drift(self):
+        self._query()
+        with self._lock:
+            expected = self._expected_copies()
+            return [StockDrift(book_id, book['title'], book['available_copies'], expected[book_id])
+                    for book_id, book in sorted(self._books.items())
+                    if book['available_copies'] != expected[book_id]]
+
+    def fix_stock_drift(self, book_ids):
+        self._query(3)
+        with self._lock:
+            expected = self._expected_copies()
+            fixed = []
+            for book_id in book_ids:
+                book = self._books.get(book_id)
+                if book and book['available_copies'] != max(expected[book_id], 0):
+                    book['available_copies'] = max(expected[book_id], 0)
+                    fixed.append((book_id, book['available_copies']))
+            return fixed
+
+    # ممیزی
+
+    def insert_audit_batch(self, batch, page_size=200):
+        self._query()
+        with self._lock:
+            self._audit_log.extend(batch)
+
+    def audit_entries(self, entity_type, entity_id, limit=20):
+        self._query()
+        with self._lock:
+            entries = [AuditEntry(created_at, chat_id, action, json.loads(payload))
+                       for chat_id, action, kind, key, payload, created_at in self._audit_log
+                       if kind == entity_type and key == entity_id]
+            entries.sort(key=lambda entry: entry.created_at, reverse=True)
+            return entries[:limit]
@@ -0,0 +1,80 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ["DATA_BACKEND"] = "memory"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from repository import InMemoryRepository  # noqa: E402
+
+
+@pytest.fixture
+def repo():
+    return InMemoryRepository()
+
+
+@pytest.fixture
+def app_module(monkeypatch, repo):
+    """ماژول app با یک مخزن درون‌حافظه‌ای تازه و صف ممیزی خالی"""
+    import app
+
+    monkeypatch.setattr(app, "repo", repo)
+    while not app.audit_queue.empty():
+        app.audit_queue.get_nowait()
+    app.audit_stop.clear()
+    yield app
+    app.stop_audit_writer(timeout=5)
+
+
+CHAT_ID = 1
+
+
+class StubBot:
+    """جایگزین bot که پیام‌ها، next-step handlerها و پاسخ callbackها را ثبت می‌کند"""
+
+    def __init__(self):
+        self.sent = []
+        self.steps = []
+        self.answered = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((text, kwargs.get("reply_markup")))
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id))
+
+    def register_next_step_handler(self, message, callback, *args):
+        self.steps.append((callback, args))
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        self.answered.append(text)
+
+    @property
+    def last_text(self):
+        return self.sent[-1][0]
+
+    def last_buttons(self):
+        return [button for row in self.sent[-1][1].keyboard for button in row]
+
+    def reply(self, text):
+        """پاسخ کاربر به آخرین next-step handler ثبت‌شده"""
+        callback, args = self.steps.pop()
+        callback(message(text), *args)
+
+
+def message(text, chat_id=CHAT_ID):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text)
+
+
+def callback(data, chat_id=CHAT_ID):
+    return SimpleNamespace(id="callback", data=data, message=message(None, chat_id))
+
+
+@pytest.fixture
+def bot(monkeypatch, app_module):
+    """bot ساختگی با یک کاربر وارد شده"""
+    stub = StubBot()
+    monkeypatch.setattr(app_module, "bot", stub)
+    monkeypatch.setitem(app_module.user_sessions, CHAT_ID, True)
+    return stub
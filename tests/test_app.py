@@ -0,0 +1,20 @@
+def test_query_budget_warns_once_for_outermost_handler(app_module, repo, monkeypatch, capsys):
+    monkeypatch.setattr(app_module, "QUERY_BUDGET", 2)
+
+    @app_module.query_budget
+    def inner():
+        repo.list_books()
+        repo.list_books()
+
+    @app_module.query_budget
+    def handler():
+        inner()
+        repo.list_books()
+
+    handler()
+    output = capsys.readouterr().out
+    assert "handler 3" in output
+    assert "inner" not in output
+
+    inner()
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,130 @@
+import signal
+import time
+from datetime import datetime
+
+import pytest
+from psycopg2 import OperationalError
+
+from conftest import message
+
+
+def test_drain_audit_queue_stops_at_batch_size(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "AUDIT_BATCH_SIZE", 3)
+    for i in range(5):
+        app_module.audit(1, "add_book", "book", i)
+
+    assert [event[3] for event in app_module.drain_audit_queue([], 1)] == [0, 1, 2]
+    assert [event[3] for event in app_module.drain_audit_queue([], 1)] == [3, 4]
+
+
+def test_drain_audit_queue_stops_at_timeout(app_module):
+    app_module.audit(1, "add_book", "book", 1)
+
+    started = time.monotonic()
+    batch = app_module.drain_audit_queue([], 0.2)
+    elapsed = time.monotonic() - started
+    assert len(batch) == 1
+    assert 0.15 <= elapsed < 1
+
+
+def test_audit_writer_flushes_pending_events_on_stop(app_module, repo, monkeypatch):
+    monkeypatch.setattr(app_module, "AUDIT_FLUSH_SECONDS", 30)
+    app_module.start_audit_writer()
+    for i in range(5):
+        app_module.audit(1, "add_book", "book", i, title=f"Book {i}")
+
+    app_module.stop_audit_writer(timeout=5)
+    assert not app_module.audit_writer.is_alive()
+    assert len(repo.audit_entries("book", 3)) == 1
+
+
+def test_audit_writer_drops_only_poison_rows(app_module, repo, monkeypatch):
+    monkeypatch.setattr(app_module, "AUDIT_FLUSH_SECONDS", 0.01)
+    monkeypatch.setattr(app_module, "AUDIT_MAX_RETRIES", 2)
+    insert = repo.insert_audit_batch
+
+    def insert_rejecting_nul(batch, page_size=200):
+        if any("\\u0000" in event[4] for event in batch):
+            raise app_module.DataError("invalid byte sequence")
+        insert(batch, page_size)
+
+    monkeypatch.setattr(repo, "insert_audit_batch", insert_rejecting_nul)
+    for i in range(6):
+        app_module.audit(1, "add_book", "book", i, title="\0" if i == 2 else "ok")
+    app_module.start_audit_writer()
+    time.sleep(0.3)
+    app_module.audit(1, "add_book", "book", 9)
+    app_module.stop_audit_writer(timeout=5)
+
+    written = sorted(event[3] for event in repo._audit_log)
+    assert written == [0, 1, 3, 4, 5, 9]
+
+
+def test_audit_writer_keeps_batch_through_connection_errors(app_module, repo, monkeypatch):
+    monkeypatch.setattr(app_module, "AUDIT_FLUSH_SECONDS", 0.01)
+    monkeypatch.setattr(app_module, "AUDIT_MAX_BACKOFF_SECONDS", 0.02)
+    insert = repo.insert_audit_batch
+    attempts = []
+
+    def insert_during_outage(batch, page_size=200):
+        attempts.append(len(batch))
+        if len(attempts) <= 8:
+            raise OperationalError("server closed the connection")
+        insert(batch, page_size)
+
+    monkeypatch.setattr(repo, "insert_audit_batch", insert_during_outage)
+    for i in range(50):
+        app_module.audit(1, "add_book", "book", i)
+    app_module.start_audit_writer()
+    deadline = time.monotonic() + 5
+    while len(repo._audit_log) < 50 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    app_module.stop_audit_writer(timeout=5)
+
+    assert len(repo._audit_log) == 50
+    assert attempts[:9] == [50] * 9
+
+
+def test_write_audit_rows_returns_rows_blocked_by_connection_errors(app_module, repo, monkeypatch):
+    def insert(batch, page_size=200):
+        raise OperationalError("connection refused")
+
+    monkeypatch.setattr(repo, "insert_audit_batch", insert)
+    batch = [(1, "add_book", "book", i, "{}", datetime.now()) for i in range(4)]
+    assert app_module.write_audit_rows(batch) == batch
+
+
+def test_borrow_and_return_are_audited_per_entity(app_module, repo, bot):
+    member_id = repo.add_member("Sara", None, None, None)
+    book_id = repo.add_book("Book", "Author", 1, None)
+
+    app_module.process_borrow_days(message("7"), book_id, member_id)
+    app_module.process_return_book(message(str(book_id)))
+    app_module.write_audit_batch(app_module.drain_audit_queue([], 0))
+
+    for entity_type, entity_id in (("book", book_id), ("member", member_id), ("borrowing", 1)):
+        entries = repo.audit_entries(entity_type, entity_id)
+        assert sorted(entry.action for entry in entries) == ["borrow", "return"]
+        assert entries[0].payload["borrowing_id"] == 1
+        assert entries[0].payload["member_id"] == member_id
+
+
+def test_audit_command_shows_entity_history(app_module, repo, bot):
+    app_module.audit(1, "add_book", "book", 5, title="Book")
+    app_module.write_audit_batch(app_module.drain_audit_queue([], 0))
+
+    app_module.show_audit_log(message("/audit book 5"))
+    assert "add_book" in bot.last_text and '"title": "Book"' in bot.last_text
+
+    app_module.show_audit_log(message("/audit book ²"))
+    assert bot.last_text.startswith("نحوه استفاده")
+
+
+def test_sigterm_stops_polling_and_exits_normally(app_module, monkeypatch):
+    stopped = []
+    monkeypatch.setattr(app_module.bot, "stop_polling", lambda: stopped.append(True))
+
+    with pytest.raises(SystemExit) as exit_info:
+        app_module.handle_sigterm(signal.SIGTERM, None)
+    assert exit_info.value.code == 0
+    assert stopped == [True]
@@ -0,0 +1,163 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import callback, message
+
+
+def test_normalization(app_module):
+    assert app_module.normalize_digits("۰۹۱۲-٣٤٥") == "0912-345"
+    assert app_module.normalize_name("  علي   كريمي ") == "علی کریمی"
+    assert app_module.normalize_phone("+98 (912) ۳۴۵-۶۷۸۹") == "989123456789"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("12", False),
+    ("4567", False),
+    ("0912", True),
+    ("۰۹۱۲", True),
+    ("912 345", True),
+    ("+98912", True),
+    ("1234567", True),
+    ("Ali", False),
+])
+def test_looks_like_phone(app_module, text, expected):
+    assert app_module.looks_like_phone(text) is expected
+
+
+def test_search_members_phone_prefix_does_not_match_id(app_module, repo):
+    for i in range(912):
+        repo.add_member(f"Member {i}", None, None, None)
+    phone_owner = repo.add_member("Sara", "0912-345-6789", None, None)
+
+    members, exact = app_module.search_members("0912")
+    assert [m.id for m in members] == [phone_owner]
+    assert exact is False
+
+
+def test_search_members_short_digits_search_id_and_phone(app_module, repo):
+    first = repo.add_member("Ali", None, None, None)
+    phone_owner = repo.add_member("Sara", "0912-345-4567", None, None)
+
+    members, exact = app_module.search_members("4567")
+    assert [m.id for m in members] == [phone_owner]
+    assert exact is False
+
+    members, exact = app_module.search_members(str(first))
+    assert [m.id for m in members] == [first]
+    assert exact is True
+
+
+def test_search_members_exact_id_with_other_matches_is_not_auto_selected(app_module, repo):
+    repo.add_member("Ali", None, None, None)
+    phone_owner = repo.add_member("Sara", "0935-111-0001", None, None)
+
+    members, exact = app_module.search_members("001")
+    assert [m.id for m in members] == [phone_owner]
+    assert exact is False
+
+    members, exact = app_module.search_members("1")
+    assert exact is True
+
+
+def test_search_members_normalizes_arabic_letters(app_module, repo):
+    member_id = repo.add_member("علی کریمی", None, None, None)
+
+    members, _ = app_module.search_members("علي")
+    assert [m.id for m in members] == [member_id]
+
+
+def test_digit_like_characters_are_not_parsed_as_codes(app_module, bot):
+    assert app_module.search_members("²") == ([], False)
+    assert app_module.normalize_phone("0912²") == "0912"
+
+    app_module.process_return_book(message("²"))
+    assert "یافت نشد" in bot.last_text
+
+
+def add_loan(repo, member_id, title="Book"):
+    book_id = repo.add_book(title, "Author", 1, None)
+    repo.create_loan(book_id, member_id, datetime.now())
+    return book_id
+
+
+def test_borrow_flow_auto_selects_only_exact_id(app_module, repo, bot):
+    member_id = repo.add_member("Sara", None, None, None)
+    book_id = repo.add_book("Book", "Author", 1, None)
+
+    app_module.process_borrow_member_id(message(str(member_id)), book_id)
+    assert "چند روز" in bot.last_text
+
+    bot.reply("7")
+    assert repo.get_book(book_id).available_copies == 0
+    assert "امانت داده شد" in bot.last_text
+
+
+def test_borrow_flow_offers_candidates_for_fragment(app_module, repo, bot):
+    repo.add_member("Ali Karimi", "0912-111-2233", None, None)
+    sara = repo.add_member("Sara Karimi", "0935-222-3344", None, None)
+    book_id = repo.add_book("Book", "Author", 1, None)
+
+    app_module.process_borrow_member_id(message("karimi"), book_id)
+    buttons = bot.last_buttons()
+    assert [b.callback_data for b in buttons] == [f"borrow_member:{book_id}:1", f"borrow_member:{book_id}:{sara}"]
+
+    app_module.borrow_member_selected(callback(buttons[1].callback_data))
+    assert "چند روز" in bot.last_text
+    bot.reply("")
+    assert "Sara Karimi" in bot.last_text
+    assert repo.member_open_loans(sara)[0].book_id == book_id
+
+
+def test_callbacks_require_login(app_module, repo, bot, monkeypatch):
+    monkeypatch.delitem(app_module.user_sessions, 1)
+
+    app_module.borrow_member_selected(callback("borrow_member:1:1"))
+    app_module.return_member_selected(callback("return_member:1"))
+    app_module.return_loan_selected(callback("return_loan:1"))
+
+    assert bot.answered == ["لطفاً ابتدا وارد سیستم شوید."] * 3
+    assert bot.sent == [] and bot.steps == []
+
+
+def test_return_flow_by_book_code(app_module, repo, bot):
+    member_id = repo.add_member("Sara", None, None, None)
+    book_id = add_loan(repo, member_id)
+
+    app_module.process_return_book(message(str(book_id)))
+    assert "پس گرفته شد" in bot.last_text
+    assert repo.get_book(book_id).available_copies == 1
+
+
+def test_return_flow_falls_back_to_phone_fragment(app_module, repo, bot):
+    member_id = repo.add_member("Sara", "0912-111-2233", None, None)
+    book_id = add_loan(repo, member_id)
+
+    app_module.process_return_book(message("2233"))
+    assert [b.callback_data for b in bot.last_buttons()] == [f"return_member:{member_id}"]
+
+    app_module.return_member_selected(callback(f"return_member:{member_id}"))
+    loan_button, = bot.last_buttons()
+
+    app_module.return_loan_selected(callback(loan_button.callback_data))
+    assert "پس گرفته شد" in bot.last_text
+    assert repo.get_book(book_id).available_copies == 1
+    assert repo.member_open_loans(member_id) == []
+
+
+def test_return_member_without_loans(app_module, repo, bot):
+    member_id = repo.add_member("Sara", None, None, None)
+
+    app_module.return_member_selected(callback(f"return_member:{member_id}"))
+    assert bot.last_text == "این عضو هیچ امانت فعالی ندارد."
+
+
+def test_return_loan_already_returned(app_module, repo, bot):
+    member_id = repo.add_member("Sara", None, None, None)
+    book_id = add_loan(repo, member_id)
+    loan_id = repo.member_open_loans(member_id)[0].id
+    app_module.process_return_book(message(str(book_id)))
+
+    app_module.return_loan_selected(callback(f"return_loan:{loan_id}"))
+    assert bot.last_text == "هیچ امانت فعالی برای این کتاب یافت نشد."
+    assert repo.get_book(book_id).available_copies == 1
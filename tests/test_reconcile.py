@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from conftest import message
+from repository import StockDrift
+
+
+def drifted_books(repo):
+    member_id = repo.add_member("Sara", None, None, None)
+    drifted = repo.add_book("Drifted", "Author", 3, None)
+    over_lent = repo.add_book("Over lent", "Author", 1, None)
+    repo.add_book("Fine", "Author", 2, None)
+    repo.create_loan(drifted, member_id, datetime.now())
+    repo._books[drifted]["available_copies"] = 3
+    repo.create_loan(over_lent, member_id, datetime.now())
+    repo._books[over_lent]["available_copies"] = 1
+    repo.create_loan(over_lent, member_id, datetime.now())
+    return drifted, over_lent
+
+
+def test_reconcile_fixes_drift_in_batches_and_audits(app_module, repo):
+    drifted, over_lent = drifted_books(repo)
+
+    discrepancies, fixed = app_module.reconcile_available_copies(chat_id=7, batch_size=1)
+
+    assert [(d.book_id, d.available_copies, d.expected) for d in discrepancies] == [
+        (drifted, 3, 2), (over_lent, 0, -1)]
+    assert fixed == 1
+    assert repo.get_book(drifted).available_copies == 2
+    assert repo.get_book(over_lent).available_copies == 0
+
+    event = app_module.audit_queue.get_nowait()
+    assert event[:4] == (7, "reconcile", "book", drifted)
+    assert app_module.audit_queue.empty()
+
+
+def test_reconcile_skips_failed_batch(app_module, repo, monkeypatch):
+    drifted, _ = drifted_books(repo)
+
+    def failing_fix(book_ids):
+        raise app_module.Error("lock timeout")
+
+    monkeypatch.setattr(repo, "fix_stock_drift", failing_fix)
+    discrepancies, fixed = app_module.reconcile_available_copies()
+    assert len(discrepancies) == 2
+    assert fixed == 0
+
+
+def test_format_reconcile_report(app_module, repo):
+    assert app_module.format_reconcile_report([], 0) == "موجودی همه کتاب‌ها با امانت‌های باز هم‌خوان است."
+
+    drifted_books(repo)
+    report = app_module.format_reconcile_report(*app_module.reconcile_available_copies())
+    assert report.startswith("ناهمخوانی موجودی در 2 کتاب (1 مورد اصلاح شد)")
+    assert "ثبت‌شده: 3 - واقعی: 2" in report
+    assert "ثبت‌شده: 0 - واقعی: 0\nهشدار: 1 امانت بیش از تعداد نسخه‌ها" in report
+
+
+def test_format_reconcile_report_truncates_long_lists(app_module):
+    rows = [StockDrift(i, f"Book {i}", 1, 0) for i in range(60)]
+    report = app_module.format_reconcile_report(rows, 60)
+    assert "Book 49" in report and "Book 50" not in report
+    assert report.endswith("و 10 مورد دیگر...")
+
+
+def test_reconcile_command_reports(app_module, repo, bot):
+    drifted_books(repo)
+
+    app_module.reconcile_command(message("/reconcile"))
+    assert bot.sent[0][0] == "در حال بررسی موجودی کتاب‌ها..."
+    assert bot.last_text.startswith("ناهمخوانی موجودی در 2 کتاب")
+
+
+def test_scheduled_reconcile_survives_unexpected_errors(app_module, monkeypatch, capsys):
+    def broken():
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app_module, "reconcile_available_copies", broken)
+    app_module.run_scheduled_reconcile()
+    assert "boom" in capsys.readouterr().out
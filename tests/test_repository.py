@@ -0,0 +1,131 @@
+import json
+from datetime import datetime, timedelta
+
+from repository import query_counter
+
+
+def count_queries(func, *args, **kwargs):
+    query_counter.begin()
+    result = func(*args, **kwargs)
+    return result, query_counter.end()
+
+
+def add_members(repo, *names):
+    return [repo.add_member(name, None, None, None) for name in names]
+
+
+def test_search_members_ranks_exact_id_then_name_prefix(repo):
+    add_members(repo, "Zahra Ali", "Ali Karimi", "Bahar Alizadeh", "Reza")
+
+    found = repo.search_members(name="ali")
+    assert [m.full_name for m in found] == ["Ali Karimi", "Bahar Alizadeh", "Zahra Ali"]
+
+    found = repo.search_members(member_id=4, name="ali")
+    assert [m.id for m in found] == [4, 2, 3, 1]
+
+
+def test_search_members_skips_inactive_and_honours_limit(repo):
+    ids = add_members(repo, "Ali One", "Ali Two", "Ali Three")
+    repo._members[ids[0]]["is_active"] = False
+
+    found = repo.search_members(name="ali", limit=1)
+    assert [m.full_name for m in found] == ["Ali Three"]
+    assert repo.search_members() == []
+
+
+def test_search_members_matches_phone_digits(repo):
+    member_id = repo.add_member("Sara", "0912-345 6789", None, None)
+
+    assert [m.id for m in repo.search_members(phone="3456")] == [member_id]
+    assert repo.search_members(phone="0000") == []
+
+
+def test_create_loan_decrements_only_available_copies(repo):
+    book_id = repo.add_book("Book", "Author", 1, None)
+    member_id, = add_members(repo, "Sara")
+    due = datetime.now() + timedelta(days=7)
+
+    loan_id, queries = count_queries(repo.create_loan, book_id, member_id, due)
+    assert loan_id is not None
+    assert queries == 2
+
+    second, queries = count_queries(repo.create_loan, book_id, member_id, due)
+    assert second is None
+    assert queries == 1
+    assert repo.get_book(book_id).available_copies == 0
+
+
+def test_close_loan_rejects_already_returned(repo):
+    book_id = repo.add_book("Book", "Author", 1, None)
+    member_id, = add_members(repo, "Sara")
+    repo.create_loan(book_id, member_id, datetime.now())
+
+    loan = repo.latest_open_loan_for_book(book_id)
+    closed, queries = count_queries(repo.close_loan, loan)
+    assert closed is True
+    assert queries == 2
+
+    closed, queries = count_queries(repo.close_loan, loan)
+    assert closed is False
+    assert queries == 1
+    assert repo.get_book(book_id).available_copies == 1
+    assert repo.latest_open_loan_for_book(book_id) is None
+    assert repo.get_open_loan(loan.id) is None
+
+
+def test_open_loan_lookups(repo):
+    first_book = repo.add_book("First", "Author", 2, None)
+    second_book = repo.add_book("Second", "Author", 1, None)
+    member_id, = add_members(repo, "Sara")
+    older = repo.create_loan(first_book, member_id, datetime.now())
+    newer = repo.create_loan(first_book, member_id, datetime.now())
+    other = repo.create_loan(second_book, member_id, datetime.now())
+
+    assert repo.latest_open_loan_for_book(first_book).id == newer
+    assert repo.get_open_loan(older).book_id == first_book
+    assert repo.get_open_loan(other).title == "Second"
+    assert repo.get_open_loan(999) is None
+    assert repo.latest_open_loan_for_book(999) is None
+
+
+def test_stock_drift_reports_over_lent_books_unclamped(repo):
+    book_id = repo.add_book("Book", "Author", 1, None)
+    member_id, = add_members(repo, "Sara")
+    repo.create_loan(book_id, member_id, datetime.now())
+    repo._books[book_id]["available_copies"] = 1
+    repo.create_loan(book_id, member_id, datetime.now())
+
+    drift = repo.stock_drift()
+    assert [(d.book_id, d.available_copies, d.expected) for d in drift] == [(book_id, 0, -1)]
+
+    fixed, queries = count_queries(repo.fix_stock_drift, [book_id])
+    assert fixed == []
+    assert queries == 3
+    assert repo.get_book(book_id).available_copies == 0
+
+
+def test_fix_stock_drift_recomputes_available_copies(repo):
+    book_id = repo.add_book("Book", "Author", 3, None)
+    other_id = repo.add_book("Other", "Author", 2, None)
+    member_id, = add_members(repo, "Sara")
+    repo.create_loan(book_id, member_id, datetime.now())
+    repo._books[book_id]["available_copies"] = 3
+
+    drift = repo.stock_drift()
+    assert [(d.book_id, d.available_copies, d.expected) for d in drift] == [(book_id, 3, 2)]
+    assert repo.fix_stock_drift([book_id, other_id]) == [(book_id, 2)]
+    assert repo.stock_drift() == []
+
+
+def test_audit_round_trip(repo):
+    now = datetime.now()
+    repo.insert_audit_batch([
+        (1, "add_book", "book", 7, json.dumps({"title": "A"}), now - timedelta(minutes=1)),
+        (None, "reconcile", "book", 7, json.dumps({"available_copies": 2}), now),
+        (1, "add_member", "member", 7, json.dumps({}), now),
+    ])
+
+    entries = repo.audit_entries("book", 7)
+    assert [(e.action, e.chat_id) for e in entries] == [("reconcile", None), ("add_book", 1)]
+    assert entries[1].payload == {"title": "A"}
+    assert len(repo.audit_entries("book", 7, limit=1)) == 1